@@ -8,13 +8,19 @@
 # The cosine distance between two pieces of text can be used as a single feature when trying to decide if two pieces of text correspond to a single person or not.
 
 
-import codecs, gensim, logging, string, re, operator, pdb
-from scipy import spatial
-from collections import OrderedDict
+import atexit, gensim, hashlib, logging, os, shelve, string, operator, threading, pdb
+from functools import lru_cache
 import numpy as np
 from sklearn import preprocessing
+from sklearn.metrics.pairwise import linear_kernel
+from joblib import Parallel, delayed
 import csv
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 word2vec_model = None
@@ -22,8 +28,12 @@ job_description = None
 word2vec_file = './data/googlenews.bin.gz'
 occupation_file = './data/OccupationData.tsv'
 # occupation_file = './data/OccupationData_half.tsv'
+# run the job-title similarity search on an int8-quantized copy of the job bank
+use_int8_jobs = True
+# on-disk text-vector cache; set to None to recompute everything each run
+vec_cache_file = './data/vec_cache'
 
-regex = re.compile('[%s]' % re.escape(string.punctuation))
+_punct_table = str.maketrans({c: ' ' for c in string.punctuation})
 
 
 
@@ -31,12 +41,19 @@ regex = re.compile('[%s]' % re.escape(string.punctuation))
 
 
 def remove_punctuation(str):
-    return regex.sub(' ', str)
+    return str.translate(_punct_table)
 
 def load_word2vec(fname):
     ''' load a pre-trained binary format word2vec into a dictionary
-    the model is downloaded from https://docs.google.com/uc?id=0B7XkCwpI5KDYNlNUTTlSS21pQmM&export=download'''
+    the model is downloaded from https://docs.google.com/uc?id=0B7XkCwpI5KDYNlNUTTlSS21pQmM&export=download
+    the first run converts the binary to gensim's native format next to it;
+    later runs memory-map that copy instead of re-parsing the 3.6 GB binary'''
+    native_fname = fname + '.kv'
+    if os.path.exists(native_fname):
+        return gensim.models.KeyedVectors.load(native_fname, mmap='r')
     word2vec = gensim.models.KeyedVectors.load_word2vec_format(fname, binary=True)
+    word2vec.vectors = np.ascontiguousarray(word2vec.vectors, dtype=np.float32)
+    word2vec.save(native_fname)
     return word2vec
 
 def load_jobs(fname):
@@ -44,9 +61,13 @@ def load_jobs(fname):
     https://www.onetcenter.org/dl_files/database/db_21_0_text/Occupation%20Data.txt'''
     
     jobtitle_jobdescription = {}
-    with codecs.open(fname, 'r', encoding='utf-8') as fin:
-        for line in fin:
-            fields = line.strip().split('\t')
+    with open(fname, 'r', newline='', encoding='utf-8') as fin:
+        reader = csv.reader(fin, delimiter='\t')
+        next(reader, None)  # header
+        for fields in reader:
+            # rows carry trailing empty columns that line.strip() used to drop
+            while fields and not fields[-1].strip():
+                fields.pop()
             if len(fields) != 3:
                 continue
             job_code = fields[0]
@@ -55,82 +76,270 @@ def load_jobs(fname):
             jobtitle_jobdescription[job_title] = _job_description
     return jobtitle_jobdescription
 
+_vec_cache = None
+# shelve/dbm does not support concurrent access, and compute_all_features
+# calls texts2mat from joblib threads; every open/read/write goes through
+# this lock (reentrant so _open_vec_cache can be called under it)
+_vec_cache_lock = threading.RLock()
+
+def _open_vec_cache():
+    '''lazily open the shelve store mapping sha1(text) -> float32 vector;
+    closed automatically at shutdown'''
+    global _vec_cache
+    with _vec_cache_lock:
+        if _vec_cache is None and vec_cache_file is not None:
+            _vec_cache = shelve.open(vec_cache_file)
+            atexit.register(_vec_cache.close)
+        return _vec_cache
+
+def _texts2mat_uncached(texts, word2vec_model):
+    '''embed a list of texts as one (len(texts), vector_size) float32 matrix of
+    mean word vectors: tokenize everything into a single flat index array plus
+    per-text offsets, gather once from the vector table and mean-pool with
+    np.add.reduceat instead of looping text2vec per text'''
+    kv = word2vec_model
+    get = kv.key_to_index.get
+    all_idx = []
+    counts = np.empty(len(texts), dtype=np.int64)
+    for n, text in enumerate(texts):
+        before = len(all_idx)
+        all_idx.extend(i for i in (get(w) for w in text.lower().split()) if i is not None)
+        counts[n] = len(all_idx) - before
+    if not all_idx:
+        return np.zeros((len(texts), kv.vector_size), dtype=np.float32)
+    all_idx = np.asarray(all_idx, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts[:-1])))
+    # reduceat runs only over texts that had tokens: their start offsets are
+    # strictly increasing and in range, so no segment swallows a neighbour's
+    # tokens; texts with no in-vocabulary words keep their zero rows
+    nonempty = np.flatnonzero(counts)
+    sums = np.add.reduceat(kv.vectors[all_idx], offsets[nonempty], axis=0)
+    mat = np.zeros((len(texts), kv.vector_size), dtype=np.float32)
+    mat[nonempty] = sums / counts[nonempty][:, None]
+    return mat
+
+def texts2mat(texts, word2vec_model):
+    '''like _texts2mat_uncached, but backed by the on-disk vector cache:
+    previously seen texts are read back by content hash and only the misses
+    are embedded (and written through), so static corpora such as the ONET
+    descriptions cost one shelve lookup per text after the first run'''
+    cache = _open_vec_cache()
+    if cache is None:
+        return _texts2mat_uncached(texts, word2vec_model)
+    keys = [hashlib.sha1(text.encode('utf-8')).hexdigest() for text in texts]
+    mat = np.empty((len(texts), word2vec_model.vector_size), dtype=np.float32)
+    misses = []
+    with _vec_cache_lock:
+        for n, key in enumerate(keys):
+            vec = cache.get(key)
+            if vec is None:
+                misses.append(n)
+            else:
+                mat[n] = vec
+    if misses:
+        # embed outside the lock; only the write-through is serialized
+        computed = _texts2mat_uncached([texts[n] for n in misses], word2vec_model)
+        for row, n in enumerate(misses):
+            mat[n] = computed[row]
+        with _vec_cache_lock:
+            for row, n in enumerate(misses):
+                cache[keys[n]] = computed[row]
+    return mat
+
 def idtext2vec(id_text, word2vec_model):
     '''convert a dictionary of id:text to text_id:vector by averaging the word vectors'''
-    id_vec = {}
-    for id, text in id_text.items():
-        vec = text2vec(text, word2vec_model)
-        id_vec[id] = vec
-    return id_vec
+    ids = list(id_text.keys())
+    mat = texts2mat([id_text[id] for id in ids], word2vec_model)
+    return dict(zip(ids, mat))
+
+@lru_cache(maxsize=None)
+def _zero_vec(size):
+    '''shared read-only zero vector for texts with no in-vocabulary words,
+    so the empty path allocates nothing; callers must not mutate it'''
+    vec = np.zeros(size, dtype=np.float32)
+    vec.setflags(write=False)
+    return vec
+
+@lru_cache(maxsize=200000)
+def _text2vec_cached(text):
+    '''per-text embedding memoized on the raw string; uses the module-level
+    word2vec_model (one model per process)'''
+    kv = word2vec_model
+    get = kv.key_to_index.get
+    idxs = np.fromiter((i for i in (get(w) for w in text.lower().split()) if i is not None),
+                       dtype=np.int64)
+    if idxs.size == 0:
+        return _zero_vec(kv.vector_size)
+    return kv.vectors[idxs].mean(axis=0)
 
 def text2vec(text, word2vec_model):
     '''convert a text to a vector by averaging the word vectors'''
-    text = text.lower()
-    words = text.split()
-    vec = 0
-    num_words = 0
-    for word in words:
-        if word in word2vec_model:
-            num_words += 1
-            vec += word2vec_model[word]
-    if num_words == 0:
-        vec = np.asarray([0] * 300)
-    else:
-        vec = vec / num_words
-    return vec
+    return _text2vec_cached(text)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cos_dist_kernel(T, J, out):
+        for i in prange(T.shape[0]):
+            for j in range(J.shape[0]):
+                s = 0.0
+                a = 0.0
+                b = 0.0
+                for k in range(T.shape[1]):
+                    s += T[i, k] * J[j, k]
+                    a += T[i, k] * T[i, k]
+                    b += J[j, k] * J[j, k]
+                out[i, j] = 1.0 - s / (np.sqrt(a) * np.sqrt(b) + 1e-12)
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cos_dist_kernel_unit_j(T, J, out):
+        # J rows are unit norm, so the per-row ||J[j]|| accumulation is skipped
+        for i in prange(T.shape[0]):
+            for j in range(J.shape[0]):
+                s = 0.0
+                a = 0.0
+                for k in range(T.shape[1]):
+                    s += T[i, k] * J[j, k]
+                    a += T[i, k] * T[i, k]
+                out[i, j] = 1.0 - s / (np.sqrt(a) + 1e-12)
+
+def cos_dist_mat(T, J, j_normalized=False):
+    '''cosine-distance matrix between two sets of row vectors; runs the numba
+    kernel (one thread per row block) when numba is installed, otherwise falls
+    back to a normalized matrix product. Pass j_normalized=True when the rows
+    of J are already unit norm to skip renormalizing them on every call.'''
+    T = np.ascontiguousarray(T, dtype=np.float32)
+    J = np.ascontiguousarray(J, dtype=np.float32)
+    out = np.empty((T.shape[0], J.shape[0]), dtype=np.float32)
+    if njit is not None:
+        if j_normalized:
+            _cos_dist_kernel_unit_j(T, J, out)
+        else:
+            _cos_dist_kernel(T, J, out)
+        return out
+    Tn = preprocessing.normalize(T)
+    Jn = J if j_normalized else preprocessing.normalize(J)
+    np.subtract(1.0, linear_kernel(Tn, Jn), out=out)
+    return out
+
+def quantize_rows(M):
+    '''symmetric per-row int8 quantization; returns (M_q, scale) with M ~= M_q / scale'''
+    scale = 127.0 / (np.max(np.abs(M), axis=1, keepdims=True) + 1e-12)
+    M_q = np.round(M * scale).astype(np.int8)
+    return M_q, scale.astype(np.float32)
+
+def cos_dist_mat_int8(T, J_q, j_scale):
+    '''cosine distances of float32 query rows T against an int8-quantized,
+    row-normalized bank: the dot products run as one int32 matrix product and
+    are rescaled back to float afterwards (4x less bandwidth on the bank)'''
+    T_q, t_scale = quantize_rows(T)
+    dots = T_q.astype(np.int32) @ J_q.T.astype(np.int32)
+    dots = dots.astype(np.float32) / (t_scale * j_scale.T)
+    # bank rows are unit norm, so only the query norms remain
+    t_norm = np.linalg.norm(T, axis=1, keepdims=True) + 1e-12
+    return 1.0 - dots / t_norm
+
+_jobmat_cache = {}
+
+def _job_matrix(jobtitle_jobdesc, word2vec_model):
+    '''sorted job titles plus their L2-normalized (num_jobs, vector_size)
+    matrix and its int8-quantized copy, built once per job dict so repeated
+    get_features calls reuse them. The dict itself is kept in the cache entry
+    so its id() cannot be recycled for a different dict while the entry lives.'''
+    key = id(jobtitle_jobdesc)
+    if key not in _jobmat_cache:
+        jobtitles = sorted(set(jobtitle_jobdesc.keys()))
+        J = texts2mat([jobtitle_jobdesc[jobtitle] for jobtitle in jobtitles], word2vec_model)
+        J = preprocessing.normalize(J, copy=False)
+        J_q, j_scale = quantize_rows(J)
+        _jobmat_cache[key] = (jobtitle_jobdesc, jobtitles, J, J_q, j_scale)
+    return _jobmat_cache[key][1:]
+
+def cos_sim(a, b):
+    '''cosine similarity of two vectors via BLAS dot products, without the
+    temporaries scipy.spatial.distance.cosine allocates per call'''
+    return np.dot(a, b) / (np.sqrt(np.dot(a, a)) * np.sqrt(np.dot(b, b)) + 1e-12)
+
+def cos_rows(A, B):
+    '''cosine similarity between matching rows of A and B'''
+    return np.einsum('ij,ij->i', A, B) / (np.linalg.norm(A, axis=1) * np.linalg.norm(B, axis=1) + 1e-12)
+
+def _job_distances(T, J, J_q, j_scale):
+    '''distance of every text row to every job title'''
+    if use_int8_jobs:
+        return cos_dist_mat_int8(T, J_q, j_scale)
+    return cos_dist_mat(T, J, j_normalized=True)
+
+# below this many pairs the joblib dispatch overhead outweighs the parallel win
+parallel_min_pairs = 1000
+
+def _compute_features_chunk(text_pairs, jobtitle_jobdesc, word2vec_model):
+    jobtitles, J, J_q, j_scale = _job_matrix(jobtitle_jobdesc, word2vec_model)
+    T1 = texts2mat([text1 for text1, text2 in text_pairs], word2vec_model)
+    T2 = texts2mat([text2 for text1, text2 in text_pairs], word2vec_model)
+    D1 = _job_distances(T1, J, J_q, j_scale)
+    D2 = _job_distances(T2, J, J_q, j_scale)
+    jobsim = cos_rows(D1, D2)
+    txtsim = cos_rows(T1, T2)
+    return np.stack([jobsim, txtsim], axis=1)
+
+def compute_all_features(text_pairs, jobtitle_jobdesc, word2vec_model):
+    '''embed each text of each pair once and return both feature columns at
+    the same time: similarity of the job-distance profiles and direct text
+    similarity. Fuses get_features and textsimilarity so no text is
+    tokenized or averaged twice. Large pair lists are split into per-core
+    chunks run on a thread pool (the pairs are independent and the heavy
+    matrix work releases the GIL).'''
+    n_chunks = os.cpu_count() or 1
+    if len(text_pairs) <= parallel_min_pairs or n_chunks < 2:
+        return _compute_features_chunk(text_pairs, jobtitle_jobdesc, word2vec_model)
+    # populate the job-matrix memo before dispatching so the workers don't
+    # all build the bank concurrently on a cold cache
+    _job_matrix(jobtitle_jobdesc, word2vec_model)
+    chunk_size = -(-len(text_pairs) // n_chunks)
+    chunks = [text_pairs[i:i + chunk_size] for i in range(0, len(text_pairs), chunk_size)]
+    parts = Parallel(n_jobs=len(chunks), prefer='threads')(
+        delayed(_compute_features_chunk)(chunk, jobtitle_jobdesc, word2vec_model)
+        for chunk in chunks)
+    return np.vstack(parts)
 
 def textsimilarity(text_pairs, word2vec_model):
-    text_similarity_features = []
-    for text_pair in text_pairs:
-        text1, text2 = text_pair
-        vec1 = text2vec(text1, word2vec_model)
-        vec2 = text2vec(text2, word2vec_model)
-        similarity = 1 - spatial.distance.cosine(vec1, vec2)
-        text_similarity_features.append(similarity)
-    features = np.asarray(text_similarity_features).reshape(len(text_similarity_features), 1)
-    return features
-        
-
-def sort_dic_by_value(dic):
-    sorted_x = sorted(dic.items(), key=operator.itemgetter(1))
-    return OrderedDict(sorted_x)
+    T1 = texts2mat([text1 for text1, text2 in text_pairs], word2vec_model)
+    T2 = texts2mat([text2 for text1, text2 in text_pairs], word2vec_model)
+    # column view of the similarity vector; no list round-trip or copy
+    return cos_rows(T1, T2)[:, None]
+
 
 def get_job_dict_ordered(id_text1, id_text2, word2vec_model):
-    id_vec1 = idtext2vec(id_text1, word2vec_model)
-    id_vec2 = idtext2vec(id_text2, word2vec_model)
-    id1_id2distances = {}
-    for id1, vec1 in id_vec1.items():
-        id2_distances = {}
-        for id2, vec2 in id_vec2.items():
-            distance = spatial.distance.cosine(vec1, vec2)
-            id2_distances[id2] = distance
-        id1_id2distances[id1] = sort_dic_by_value(id2_distances)
-    return id1_id2distances
+    '''for every id in id_text1 return (ids2, distances) where distances[i] is
+    the cosine distance to the text of ids2[i]; rows are unsorted so callers
+    can pick a top-K with argpartition instead of paying a full sort'''
+    ids1 = list(id_text1.keys())
+    ids2 = list(id_text2.keys())
+    mat1 = texts2mat([id_text1[id] for id in ids1], word2vec_model)
+    mat2 = texts2mat([id_text2[id] for id in ids2], word2vec_model)
+    distances = cos_dist_mat(mat1, mat2)
+    return {id1: (ids2, distances[row]) for row, id1 in enumerate(ids1)}
+
+def top_k_ids(ids, distances, k):
+    '''k ids with the smallest distances, ordered; O(M) partition + O(k log k) sort'''
+    k = min(k, len(ids))
+    top = np.argpartition(distances, k - 1)[:k]
+    top = top[np.argsort(distances[top])]
+    return [ids[i] for i in top]
 
 
 def get_features(text_pairs, jobtitle_jobdesc, word2vec_model):
     '''given a list of text pairs as [('t11', 't12'), ('t21', 't22')....]
     returns features, a vector where the first element is the job similarity of 't11', 't12'.
     The length of the features vector equals the length of the pairs.'''
-    jobtitle_vec = idtext2vec(jobtitle_jobdesc, word2vec_model)
-    jobtitles = sorted(set(jobtitle_vec.keys()))
-    features = []
-    for text_pair in text_pairs:
-        text1, text2 = text_pair
-        vec1 = text2vec(text1, word2vec_model)
-        vec2 = text2vec(text2, word2vec_model)
-        vec1distances = []
-        vec2distances = []
-        for jobtitle in jobtitles:
-            vec = jobtitle_vec[jobtitle]
-            distance1 = spatial.distance.cosine(vec1, vec)
-            distance2 = spatial.distance.cosine(vec2, vec)
-            vec1distances.append(distance1)
-            vec2distances.append(distance2)
-        jobsim = 1 - spatial.distance.cosine(vec1distances, vec2distances)
-        features.append(jobsim)
-    features = np.asarray(features).reshape(len(features), 1)
-    return features
+    jobtitles, J, J_q, j_scale = _job_matrix(jobtitle_jobdesc, word2vec_model)
+    T1 = texts2mat([text1 for text1, text2 in text_pairs], word2vec_model)
+    T2 = texts2mat([text2 for text1, text2 in text_pairs], word2vec_model)
+    D1 = _job_distances(T1, J, J_q, j_scale)
+    D2 = _job_distances(T2, J, J_q, j_scale)
+    # cosine similarity between the two distance profiles of each pair
+    jobsim = cos_rows(D1, D2)
+    return jobsim[:, None]
 
 def normalize_features(train_features, test_features):
     ''' scale the feature values '''
@@ -139,49 +348,34 @@ def normalize_features(train_features, test_features):
     scaler.fit(train_features)
     normal_train = scaler.transform(train_features)
     test_features = scaler.transform(test_features)
-    return train_features, test_features
+    return normal_train, test_features
 
 
 # In[117]:
 
 
-def import_train_test_data(train_file, test_file):
-#     html_dir = './data/html_clean/'
-    train_pairs = {}
-    test_pairs = {}
-
-    # Load train file
-    with open(train_file, 'r') as fin:
+def _read_pairs(fname):
+    '''read one search-results csv as a list of (pair_id, text1, text2)
+    tuples sorted by pair_id'''
+    rows = []
+    with open(fname, 'r', newline='') as fin:
         reader = csv.reader(fin, delimiter=',', quotechar='"')
-        header = True
+        next(reader, None)  # header
         for row in reader:
-            if header:
-                header = False
-                continue
-
             pair_id = int(row[0])
             title1 = row[2]
             title2 = row[5]
             text1 = row[3]
             text2 = row[6]
-            train_pairs[pair_id] = (title1 + ' ' + text1 , title2 + ' ' + text2)
+            rows.append((pair_id, title1 + ' ' + text1, title2 + ' ' + text2))
+    rows.sort(key=operator.itemgetter(0))
+    return rows
 
-    # Load test file
-    with open(test_file, 'r') as fin:
-        reader = csv.reader(fin, delimiter=',', quotechar='"')
-        header = True
-        for row in reader:
-            if header:
-                header = False
-                continue
-
-            pair_id = int(row[0])
-            title1 = row[2]
-            title2 = row[5]
-            text1 = row[3]
-            text2 = row[6]
-            test_pairs[pair_id] = (title1 + ' ' + text1 , title2 + ' ' + text2)
-    return train_pairs, test_pairs        
+def import_train_test_data(train_file, test_file):
+#     html_dir = './data/html_clean/'
+    train_pairs = _read_pairs(train_file)
+    test_pairs = _read_pairs(test_file)
+    return train_pairs, test_pairs
 
 
 # In[118]:
@@ -195,12 +389,15 @@ def sanity_check(word2vec_model, job_description):
     # just for sanity check
 
         text_job_distances = get_job_dict_ordered({1:query}, job_description, word2vec_model)
-    # print(list(text_job_distances[1].keys())[0:30]) 
-        print(list(text_job_distances[1].keys())[0:10]) 
+        jobtitles, distances = text_job_distances[1]
+    # print(top_k_ids(jobtitles, distances, 30))
+        print(top_k_ids(jobtitles, distances, 10))
     
 
 def write_features(feature_file, features):
-    np.savetxt(feature_file, features)
+    '''write features as binary .npy; read back with np.load (mmap_mode='r'
+    gives zero-copy access)'''
+    np.save(feature_file, features)
 
 
 # In[ ]:
@@ -215,17 +412,13 @@ if __name__ == '__main__':
     job_description = {job:job + ' ' + desc for job, desc in job_description.items()}
     logging.info('loading word2vec model (takes a while)...')
     word2vec_model = load_word2vec(fname=word2vec_file)
-    train_features_job = get_features(text_pairs=[train_pairs[id] for id in sorted(train_pairs.keys())], jobtitle_jobdesc=job_description, word2vec_model=word2vec_model) 
-    test_features_job = get_features(text_pairs=[test_pairs[id] for id in sorted(test_pairs.keys())], jobtitle_jobdesc=job_description, word2vec_model=word2vec_model)
-    train_features_txtsim = textsimilarity(text_pairs=[train_pairs[id] for id in sorted(train_pairs.keys())], word2vec_model=word2vec_model)
-    test_features_txtsim = textsimilarity(text_pairs=[test_pairs[id] for id in sorted(test_pairs.keys())], word2vec_model=word2vec_model)
-    train_features = np.hstack((train_features_job, train_features_txtsim))
-    test_features = np.hstack((test_features_job, test_features_txtsim))
-    train_features = preprocessing.scale(train_features) #wherecomments 
-    test_features = preprocessing.scale(test_features) #wherecomments 
-    train_features, test_features = normalize_features(train_features=train_features, test_features=test_features) #wherecomments 
+    train_texts = [(text1, text2) for pair_id, text1, text2 in train_pairs]
+    test_texts = [(text1, text2) for pair_id, text1, text2 in test_pairs]
+    train_features = compute_all_features(text_pairs=train_texts, jobtitle_jobdesc=job_description, word2vec_model=word2vec_model)
+    test_features = compute_all_features(text_pairs=test_texts, jobtitle_jobdesc=job_description, word2vec_model=word2vec_model)
+    train_features, test_features = normalize_features(train_features=train_features, test_features=test_features)
     features = np.vstack((train_features, test_features))
-    np.savetxt('./data/features.txt', features)
+    write_features('./data/features.npy', features)
     sanity_check(word2vec_model,job_description)
     # pdb.set_trace()
 